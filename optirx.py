@@ -5,13 +5,28 @@
 from __future__ import print_function
 
 
+import select
 import socket
 import struct
 import threading
-from collections import namedtuple
+import zlib
+from collections import OrderedDict, namedtuple
+from operator import itemgetter
 from platform import python_version_tuple
 from time import sleep
 
+try:
+    import selectors
+except ImportError:
+    # Python < 3.4, fall back to select.select()
+    selectors = None
+
+try:
+    import numpy as np
+except ImportError:
+    # optional, required only by MarkerIndex
+    np = None
+
 
 if python_version_tuple()[0] < "3":
     pass
@@ -30,8 +45,23 @@ __all__ = [
     # functions:
     'mkcmdsock', 'mkdatasock', 'unpack',
 
+    # decoders:
+    'FramePlan', 'FrameDecoder',
+
+    # spatial queries:
+    'MarkerIndex', 'match_markers',
+
+    # transforms:
+    'TransformEngine', 'quat_multiply', 'quat_rotate', 'quat_conjugate',
+
+    # callbacks:
+    'Dispatcher',
+
+    # recording:
+    'CaptureWriter', 'CaptureReader',
+
     #threads:
-    'DataThread']
+    'DataThread', 'MultiSourceThread', 'SourcePacket', 'SourceStats']
 
 
 ###
@@ -152,6 +182,7 @@ LabeledMarker = namedtuple("LabeledMarker", "id position size occluded point_clo
 #  - is_recording (boolean), version >= 2.6(?),
 #  - tracked_models_changed (boolean), version >= 2.6(?),
 #  - end of data tag (int).
+# sets is an OrderedDict of marker lists by set name, in the order of the packet.
 FrameOfData = namedtuple("FrameOfData", "frameno sets other_markers rigid_bodies skeletons labeled_markers latency timecode timestamp is_recording tracked_models_changed")
 
 
@@ -159,7 +190,9 @@ FrameOfData = namedtuple("FrameOfData", "frameno sets other_markers rigid_bodies
 # name is a string (possibly empty)
 # data can be
 #   - a list of strings (names of the markers for a markerset)
-#   - a list of rigid bodies' dictionaries
+#   - a list of rigid bodies' dictionaries (for a rigid body)
+#   - a dictionary with the skeleton "id" and a list of "rigid_bodies"'
+#     dictionaries, which also have "name"s (for a skeleton)
 ModelDataset = namedtuple("ModelDataset", "type name data")
 
 
@@ -308,7 +341,7 @@ def _unpack_force_plates(data, version):
 def _unpack_frameofdata(data, version):
     (frameno, nsets), data = _unpack_head("ii", data)
     # identified marker sets
-    sets = {}
+    sets = OrderedDict()
     for i in xrange(nsets):
         setname, data = _unpack_cstring(data, MAX_NAMELENGTH)
         markers, data = _unpack_markers(data, version)
@@ -368,7 +401,7 @@ def _unpack_modeldef(data, version):
             name, data = _unpack_cstring(data, MAX_NAMELENGTH)
             (nmarkers,), data = _unpack_head("i", data)
             mrk_names = []
-            for j in xrange(nMarkers):
+            for j in xrange(nmarkers):
                 mrk_name, data = _unpack_cstring(data, MAX_NAMELENGTH)
                 mrk_names.append(mrk_name)
             dset = ModelDataset(DATASET_MARKERSET, name, mrk_names)
@@ -395,10 +428,12 @@ def _unpack_modeldef(data, version):
                     bname = ""
                 (rbid, parent, xoff, yoff, zoff), data = _unpack_head("2i3f", data)
                 body = {"id": rbid,
+                        "name": bname,
                         "parent": parent,
                         "offset": (xoff, yoff, zoff)}
                 bodies.append(body)
-            dset = ModelDataset(DATASET_RIGIDBODY, name, bodies)
+            dset = ModelDataset(DATASET_SKELETON, name,
+                                {"id": skid, "rigid_bodies": bodies})
             datasets.append(dset)
         else:
             raise NotImplementedError("dataset type " + str(dtype))
@@ -429,6 +464,1360 @@ def unpack(data, version=(2, 5, 0, 0)):
         raise NotImplementedError("packet type " + str(NAT_TYPES.get(msgtype, msgtype)))
 
 
+###
+### Fixed-layout decoding of stable scenes ###
+###
+
+
+def _triples(values):
+    "Group a flat sequence of coordinates into a list of triples."
+    it = iter(values)
+    return list(zip(it, it, it))
+
+
+class FramePlan(object):
+    """Precompiled layout of FrameOfData packets of a stable scene.
+
+    A plan is learned from a decoded frame: the marker set names and
+    sizes, rigid body and skeleton IDs and marker counts are assumed not
+    to change, so that every block of the frame between the variable-size
+    lists of other and labeled markers is unpacked with a single
+    struct.Struct. The fields which describe the layout are compared
+    with the plan before the frame is accepted.
+    """
+
+    def __init__(self, frame, version):
+        """Arguments:
+          frame    FrameOfData to learn the layout from; the order of
+                   frame.sets must be the order of the packet
+          version  version of the NatNet protocol (a tuple of integers)
+        """
+        self.version = version
+        self._marker_data = _version_is_at_least(version, 2, 0)
+        self._tracking_valid = _version_is_at_least(version, 2, 6)
+        self._has_skeletons = _version_is_at_least(version, 2, 1)
+        self._has_labeled = _version_is_at_least(version, 2, 3)
+        self._lm_params = _version_is_at_least(version, 2, 6)
+        self._has_plates = _version_is_at_least(version, 2, 9)
+        self._structs = {}
+
+        # frameno, marker sets
+        fmt, checks, sets = ["=ii"], [(1, len(frame.sets))], []
+        idx = 2
+        for name, markers in frame.sets.items():
+            bname = name.encode("utf-8") + b"\0"
+            fmt.append("%dsi%df" % (len(bname), 3 * len(markers)))
+            checks.extend([(idx, bname), (idx + 1, len(markers))])
+            sets.append((name, idx + 2, idx + 2 + 3 * len(markers)))
+            idx += 2 + 3 * len(markers)
+        self._sets_struct = struct.Struct("".join(fmt))
+        self._sets_check = self._checker(checks)
+        self._sets = sets
+
+        # rigid bodies and skeletons
+        fmt, checks = ["=i"], [(0, len(frame.rigid_bodies))]
+        self._bodies, idx = self._plan_bodies(frame.rigid_bodies, 1, fmt, checks)
+        self._skeletons = []
+        if self._has_skeletons:
+            fmt.append("i")
+            checks.append((idx, len(frame.skeletons)))
+            idx += 1
+            for sk in frame.skeletons:
+                fmt.append("ii")
+                checks.extend([(idx, sk.id), (idx + 1, len(sk.rigid_bodies))])
+                bodies, idx = self._plan_bodies(sk.rigid_bodies, idx + 2, fmt, checks)
+                self._skeletons.append((sk.id, bodies))
+        self._bodies_struct = struct.Struct("".join(fmt))
+        self._bodies_check = self._checker(checks)
+
+        # force plates, latency, timecode, timestamp, params, end of data
+        if _version_is_at_least(version, 2, 7):
+            tail = "fIIdh"
+        elif _version_is_at_least(version, 2, 6):
+            tail = "fIIfh"
+        else:
+            tail = "fII"
+        if self._has_plates:
+            self._tail_struct = struct.Struct("=i" + tail + "i")
+        else:
+            self._tail_struct = struct.Struct("=" + tail + "i")
+
+    @staticmethod
+    def _checker(checks):
+        """Return a function to get layout fields and their expected values."""
+        idxs, expected = zip(*checks)
+        if len(idxs) == 1:
+            return itemgetter(idxs[0]), expected[0]
+        return itemgetter(*idxs), expected
+
+    def _plan_bodies(self, bodies, idx, fmt, checks):
+        """Extend the format and checks with a sequence of rigid bodies
+        (without the count) starting at the value number idx.
+        Return a list of (id, value number, marker count) and the next
+        value number."""
+        plan = []
+        for rb in bodies:
+            n = len(rb.markers)
+            fmt.append("i3f4fi%df" % (3 * n))
+            checks.extend([(idx, rb.id), (idx + 8, n)])
+            plan.append((rb.id, idx, n))
+            idx += 9 + 3 * n
+            if self._marker_data:
+                fmt.append("%di%dff" % (n, n))
+                idx += 2 * n + 1
+                if self._tracking_valid:
+                    fmt.append("h")
+                    idx += 1
+        return plan, idx
+
+    def _struct(self, fmt, n):
+        "Return a cached struct.Struct for n repetitions of fmt."
+        s = self._structs.get((fmt, n))
+        if s is None:
+            s = self._structs[(fmt, n)] = struct.Struct("=" + fmt * n)
+        return s
+
+    def _make_bodies(self, plan, vals):
+        md, tv = self._marker_data, self._tracking_valid
+        bodies = []
+        for rbid, i, n in plan:
+            m = i + 9 + 3 * n
+            if md:
+                mrk_ids = vals[m:m+n]
+                mrk_sizes = vals[m+n:m+2*n]
+                mrk_mean_error = vals[m+2*n]
+                tracking_valid = vals[m+2*n+1] & 0x01 == 1 if tv else None
+            else:
+                mrk_ids, mrk_sizes, mrk_mean_error, tracking_valid = None, None, None, None
+            bodies.append(RigidBody(id=rbid,
+                                    position=vals[i+1:i+4],
+                                    orientation=vals[i+4:i+8],
+                                    markers=_triples(vals[i+9:m]),
+                                    mrk_ids=mrk_ids,
+                                    mrk_sizes=mrk_sizes,
+                                    mrk_mean_error=mrk_mean_error,
+                                    tracking_valid=tracking_valid))
+        return bodies
+
+    def unpack(self, data, offset=4):
+        """Unpack a FrameOfData payload starting at offset.
+
+        Return FrameOfData, or None if the frame does not match the plan
+        or its tracked_models_changed flag is set.
+        """
+        try:
+            vals = self._sets_struct.unpack_from(data, offset)
+            getter, expected = self._sets_check
+            if getter(vals) != expected:
+                return None
+            offset += self._sets_struct.size
+            frameno = vals[0]
+            sets = OrderedDict()
+            for name, start, stop in self._sets:
+                sets[name] = _triples(vals[start:stop])
+
+            (n,) = struct.unpack_from("=i", data, offset)
+            s = self._struct("3f", n)
+            other_markers = _triples(s.unpack_from(data, offset + 4))
+            offset += 4 + s.size
+
+            vals = self._bodies_struct.unpack_from(data, offset)
+            getter, expected = self._bodies_check
+            if getter(vals) != expected:
+                return None
+            offset += self._bodies_struct.size
+            bodies = self._make_bodies(self._bodies, vals)
+            skels = [Skeleton(id=skid, rigid_bodies=self._make_bodies(plan, vals))
+                     for skid, plan in self._skeletons]
+
+            lmarkers = []
+            if self._has_labeled:
+                (n,) = struct.unpack_from("=i", data, offset)
+                if self._lm_params:
+                    s = self._struct("i4fh", n)
+                    vals = s.unpack_from(data, offset + 4)
+                    for i in xrange(0, 6 * n, 6):
+                        params = vals[i+5]
+                        lmarkers.append(LabeledMarker(vals[i], vals[i+1:i+4], vals[i+4],
+                                                      params & 0x01 == 1,
+                                                      params & 0x02 == 2,
+                                                      params & 0x04 == 4))
+                else:
+                    s = self._struct("i4f", n)
+                    vals = s.unpack_from(data, offset + 4)
+                    for i in xrange(0, 5 * n, 5):
+                        lmarkers.append(LabeledMarker(vals[i], vals[i+1:i+4], vals[i+4],
+                                                      None, None, None))
+                offset += 4 + s.size
+
+            vals = self._tail_struct.unpack_from(data, offset)
+        except struct.error:
+            return None
+        if self._has_plates:
+            if vals[0] != 0:
+                return None
+            vals = vals[1:]
+        if vals[-1] != 0:
+            return None
+        if len(vals) == 6:
+            latency, timecode, timecode_sub, timestamp, params, _ = vals
+            is_recording = params & 0x01 == 1
+            tracked_models_changed = params & 0x02 == 2
+            if tracked_models_changed:
+                return None
+        else:
+            latency, timecode, timecode_sub, _ = vals
+            timestamp, is_recording, tracked_models_changed = None, None, None
+        return FrameOfData(frameno=frameno,
+                           sets=sets,
+                           other_markers=other_markers,
+                           rigid_bodies=bodies,
+                           skeletons=skels,
+                           labeled_markers=lmarkers,
+                           latency=latency,
+                           timecode=(timecode, timecode_sub),
+                           timestamp=timestamp,
+                           is_recording=is_recording,
+                           tracked_models_changed=tracked_models_changed)
+
+
+class FrameDecoder(object):
+    """Stateful replacement of `unpack` for a stream of packets.
+
+    The NatNet version is updated from SenderData. A FramePlan is learned
+    once two consecutive frames unpacked without a plan have the same
+    layout, and used for the following frames; it is dropped when a frame
+    does not match it, when tracked_models_changed is set, or when new
+    ModelDefs or SenderData arrive. So a layout which keeps changing costs
+    only the generic `unpack`, not a new plan for every frame.
+    """
+
+    def __init__(self, version=(2, 5, 0, 0)):
+        """Arguments:
+          version  initial version of the NatNet protocol (a tuple of integers)
+        """
+        self.version = version
+        self.plan = None
+        # layout of the last frame unpacked without the plan
+        self._layout = None
+        # number of frames unpacked with and without the plan
+        self.planned = 0
+        self.unplanned = 0
+
+    def unpack(self, data):
+        """Unpack raw NatNet packet data, see `unpack`."""
+        if self.plan is not None and len(data) >= 4:
+            (msgtype,) = struct.unpack_from("=H", data)
+            if msgtype == NAT_FRAMEOFDATA:
+                frame = self.plan.unpack(data)
+                if frame is not None:
+                    self.planned += 1
+                    return frame
+        packet = unpack(data, version=self.version)
+        if type(packet) is FrameOfData:
+            self.unplanned += 1
+            self.plan = None
+            if packet.tracked_models_changed:
+                self._layout = None
+            else:
+                layout = _frame_layout(packet)
+                if layout == self._layout:
+                    self.plan = FramePlan(packet, self.version)
+                self._layout = layout
+        elif type(packet) is SenderData:
+            self.version = packet.natnet_version
+            self.plan = None
+            self._layout = None
+        elif type(packet) is ModelDefs:
+            self.plan = None
+            self._layout = None
+        return packet
+
+
+###
+### Spatial queries over markers (require NumPy) ###
+###
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("NumPy is required for spatial queries over markers")
+
+
+def _expand_ranges(starts, stops):
+    """Concatenate ranges [starts[i], stops[i]).
+    Return the concatenated values and the range number of each value."""
+    counts = stops - starts
+    owner = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    values = np.arange(counts.sum()) - offsets[owner] + starts[owner]
+    return values, owner
+
+
+class MarkerIndex(object):
+    """Uniform grid over a set of markers for nearest-neighbor and
+    radius queries.
+
+    Markers are bucketed into cubic cells of `cell_size` and sorted by
+    (x, y) columns of cells; only the columns with markers are stored, so
+    the size of the index does not depend on the extent of the markers.
+    All queries are batched over many query points at once.
+
+    >>> idx = MarkerIndex([(0, 0, 0), (1, 0, 0), (0, 0.1, 0)], cell_size=0.5)
+    >>> idx.nearest([(0.9, 0, 0), (5, 5, 5)])[0].tolist()
+    [1, -1]
+
+    """
+
+    def __init__(self, points, cell_size=0.05):
+        """Build the index.
+
+        Arguments:
+          points     a sequence of coordinate triples or an Nx3 array
+          cell_size  grid step, the same units as marker coordinates;
+                     should be about the typical query radius
+        """
+        _require_numpy()
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        self.cell_size = float(cell_size)
+        cells = np.floor(self.points / self.cell_size).astype(np.int64)
+        if len(cells):
+            self._origin = cells.min(axis=0)
+            self._shape = cells.max(axis=0) - self._origin + 1
+        else:
+            self._origin = np.zeros(3, dtype=np.int64)
+            self._shape = np.ones(3, dtype=np.int64)
+        # markers are sorted by (x, y) columns of cells; only columns with
+        # markers are stored: markers of the column self._columns[i] are
+        # self._order[self._colstart[i]:self._colstart[i+1]]
+        columns = self._column_keys(cells - self._origin)
+        self._order = np.argsort(columns, kind="mergesort")
+        self._columns, starts = np.unique(columns[self._order], return_index=True)
+        self._colstart = np.append(starts, len(columns)).astype(np.intp)
+
+    @classmethod
+    def from_frame(cls, frame, cell_size=0.05, sets=False):
+        """Build the index over the markers of a FrameOfData.
+
+        Only unidentified markers (`other_markers`) are indexed, unless
+        `sets` is true, then markers of all marker sets are appended
+        in the order of `sorted(frame.sets)`.
+        """
+        _require_numpy()
+        points = [frame.other_markers]
+        if sets:
+            points.extend(frame.sets[name] for name in sorted(frame.sets))
+        points = [np.asarray(p, dtype=np.float64).reshape(-1, 3) for p in points]
+        return cls(np.concatenate(points), cell_size=cell_size)
+
+    def __len__(self):
+        return len(self.points)
+
+    def _column_keys(self, cells):
+        return cells[..., 0] * self._shape[1] + cells[..., 1]
+
+    def pairs_within(self, queries, radius):
+        """Find all markers within `radius` of each query point.
+
+        Return three arrays of the same length: query numbers, marker
+        numbers and distances between them.
+        """
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 3)
+        empty = (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp),
+                 np.zeros(0, dtype=np.float64))
+        if not len(self.points) or not len(queries):
+            return empty
+        rings = int(np.ceil(radius / self.cell_size))
+        lo = np.floor((queries - radius) / self.cell_size).astype(np.int64) - self._origin
+        hi = np.floor((queries + radius) / self.cell_size).astype(np.int64) - self._origin
+        lo = np.maximum(lo, 0)
+        hi = np.minimum(hi, self._shape - 1)
+        # (x, y) columns around every query, query numbers of the columns
+        span = np.arange(2 * rings + 1)
+        steps = np.stack(np.meshgrid(span, span, indexing="ij"), axis=-1).reshape(-1, 2)
+        cols = lo[:, None, :2] + steps[None, :, :]
+        ok = np.all(cols <= hi[:, None, :2], axis=2) & (lo[:, None, 2] <= hi[:, None, 2])
+        qnums = np.nonzero(ok)[0]
+        columns = self._column_keys(cols[ok])
+        # look up the occupied columns
+        found = np.searchsorted(self._columns, columns)
+        found[found == len(self._columns)] = 0
+        occupied = self._columns[found] == columns
+        found, qnums = found[occupied], qnums[occupied]
+        slots, owner = _expand_ranges(self._colstart[found],
+                                      self._colstart[found + 1])
+        qi = qnums[owner]
+        mi = self._order[slots]
+        dist = np.sqrt(((self.points[mi] - queries[qi]) ** 2).sum(axis=1))
+        within = dist <= radius
+        return qi[within], mi[within], dist[within]
+
+    def query_radius(self, queries, radius):
+        """Return a list of arrays of marker numbers within `radius` of
+        each query point."""
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 3)
+        if not len(queries):
+            return []
+        qi, mi, _ = self.pairs_within(queries, radius)
+        order = np.argsort(qi, kind="mergesort")
+        bounds = np.searchsorted(qi[order], np.arange(1, len(queries)))
+        return np.split(mi[order], bounds)
+
+    def nearest(self, queries, max_distance=None):
+        """Find the nearest marker for each query point.
+
+        Only markers within `max_distance` (`cell_size` by default) are
+        considered. Return an array of marker numbers (-1 if none found)
+        and an array of distances (inf if none found).
+        """
+        if max_distance is None:
+            max_distance = self.cell_size
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 3)
+        found = np.full(len(queries), -1, dtype=np.intp)
+        dists = np.full(len(queries), np.inf)
+        qi, mi, d = self.pairs_within(queries, max_distance)
+        if len(qi):
+            # the closest pair comes first for every query
+            order = np.lexsort((d, qi))
+            qi, mi, d = qi[order], mi[order], d[order]
+            first = np.ones(len(qi), dtype=bool)
+            first[1:] = qi[1:] != qi[:-1]
+            found[qi[first]] = mi[first]
+            dists[qi[first]] = d[first]
+        return found, dists
+
+
+def match_markers(previous, current, max_distance, cell_size=None):
+    """Find frame-to-frame correspondence of unlabeled markers.
+
+    A marker of the previous frame is matched to a marker of the current
+    frame if they are mutual nearest neighbors within `max_distance`.
+
+    Arguments:
+      previous      coordinates of markers in the previous frame (or a MarkerIndex)
+      current       coordinates of markers in the current frame (or a MarkerIndex)
+      max_distance  maximal marker displacement between frames
+      cell_size     grid step of the indices to build (`max_distance` by default)
+
+    Return an array, for every previous marker, of the number of the
+    matching current marker, or -1.
+    """
+    _require_numpy()
+    cell_size = max_distance if cell_size is None else cell_size
+    if not isinstance(previous, MarkerIndex):
+        previous = MarkerIndex(previous, cell_size)
+    if not isinstance(current, MarkerIndex):
+        current = MarkerIndex(current, cell_size)
+    forward, _ = current.nearest(previous.points, max_distance)
+    backward, _ = previous.nearest(current.points, max_distance)
+    matched = forward >= 0
+    mutual = np.zeros(len(forward), dtype=bool)
+    mutual[matched] = backward[forward[matched]] == np.nonzero(matched)[0]
+    return np.where(mutual, forward, -1)
+
+
+###
+### Batched rigid body and skeleton transforms (require NumPy) ###
+###
+
+# Quaternions are arrays of (qx, qy, qz, qw), as in NatNet packets.
+
+
+def quat_conjugate(q, out=None):
+    """Conjugate (inverse of a unit) quaternions of shape (..., 4)."""
+    q = np.asarray(q, dtype=np.float64)
+    if out is None:
+        out = np.empty(q.shape)
+    out[..., :3] = -q[..., :3]
+    out[..., 3] = q[..., 3]
+    return out
+
+
+def quat_multiply(a, b, out=None):
+    """Hamilton product a*b of quaternions of shape (..., 4).
+
+    >>> quat_multiply([0, 0, 1, 0], [0, 0, 1, 0]).tolist()
+    [0.0, 0.0, 0.0, -1.0]
+
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    ax, ay, az, aw = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+    bx, by, bz, bw = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+    x = aw * bx + ax * bw + ay * bz - az * by
+    y = aw * by - ax * bz + ay * bw + az * bx
+    z = aw * bz + ax * by - ay * bx + az * bw
+    w = aw * bw - ax * bx - ay * by - az * bz
+    if out is None:
+        out = np.empty(np.broadcast(a, b).shape)
+    out[..., 0], out[..., 1], out[..., 2], out[..., 3] = x, y, z, w
+    return out
+
+
+def quat_rotate(q, v, out=None):
+    """Rotate vectors of shape (..., 3) by unit quaternions of shape (..., 4).
+
+    >>> (quat_rotate([0, 0, 0.7071068, 0.7071068], [1, 0, 0]).round(6) + 0.0).tolist()
+    [0.0, 1.0, 0.0]
+
+    """
+    q = np.asarray(q, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64)
+    qx, qy, qz, qw = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    vx, vy, vz = v[..., 0], v[..., 1], v[..., 2]
+    # v + 2w(u x v) + 2u x (u x v), where u = (qx, qy, qz)
+    tx = 2.0 * (qy * vz - qz * vy)
+    ty = 2.0 * (qz * vx - qx * vz)
+    tz = 2.0 * (qx * vy - qy * vx)
+    x = vx + qw * tx + (qy * tz - qz * ty)
+    y = vy + qw * ty + (qz * tx - qx * tz)
+    z = vz + qw * tz + (qx * ty - qy * tx)
+    if out is None:
+        out = np.empty(np.broadcast(q[..., :3], v).shape)
+    out[..., 0], out[..., 1], out[..., 2] = x, y, z
+    return out
+
+
+class _Buffers(object):
+    """Named arrays which are reallocated only when they grow."""
+
+    def __init__(self):
+        self._arrays = {}
+
+    def get(self, name, n, width, dtype=None):
+        dtype = np.float64 if dtype is None else dtype
+        arr = self._arrays.get(name)
+        if arr is None or len(arr) < n:
+            arr = np.empty((max(n, 2 * len(arr) if arr is not None else n), width), dtype)
+            self._arrays[name] = arr
+        return arr[:n]
+
+
+class TransformEngine(object):
+    """Batched coordinate transforms of all rigid bodies and skeletons of
+    a frame.
+
+    The skeleton hierarchy (bone parents and offsets) is precomputed from
+    ModelDefs. Bones of all skeletons are processed together, one level
+    of the hierarchy at a time. Results are views into buffers owned by
+    the engine, valid until the next call of the same method; pass `out`
+    to keep them.
+    """
+
+    def __init__(self, modeldefs=None):
+        """Arguments:
+          modeldefs  ModelDefs with skeleton descriptions, if any
+        """
+        _require_numpy()
+        self._buffers = _Buffers()
+        self.set_modeldefs(modeldefs)
+
+    def set_modeldefs(self, modeldefs):
+        """Precompute the hierarchy of skeleton bones from ModelDefs."""
+        bones = []     # (skeleton id, bone id)
+        parents = []   # number of the parent bone or -1
+        offsets = []
+        if modeldefs is not None:
+            for dset in modeldefs.datasets:
+                if dset.type != DATASET_SKELETON:
+                    continue
+                skid = dset.data["id"]
+                first = len(bones)
+                numbers = dict((body["id"], first + i)
+                               for i, body in enumerate(dset.data["rigid_bodies"]))
+                for body in dset.data["rigid_bodies"]:
+                    bones.append((skid, body["id"]))
+                    parents.append(numbers.get(body["parent"], -1))
+                    offsets.append(body["offset"])
+        self.bones = bones
+        self._bone_numbers = dict((bone, i) for i, bone in enumerate(bones))
+        self._parents = np.array(parents, dtype=np.intp)
+        self._offsets = np.array(offsets, dtype=np.float64).reshape(-1, 3)
+        # levels of the hierarchy: (bones, their parents) at every depth
+        depth = [None] * len(bones)
+
+        def get_depth(i):
+            if depth[i] is None:
+                depth[i] = 0  # guards against cycles
+                p = parents[i]
+                depth[i] = 0 if p < 0 else get_depth(p) + 1
+            return depth[i]
+
+        for i in xrange(len(bones)):
+            get_depth(i)
+        self._roots = np.array([i for i in xrange(len(bones)) if depth[i] == 0],
+                               dtype=np.intp)
+        self._levels = []
+        for d in xrange(1, max(depth) + 1 if depth else 1):
+            idx = np.array([i for i in xrange(len(bones)) if depth[i] == d], dtype=np.intp)
+            self._levels.append((idx, self._parents[idx]))
+
+    def bone_number(self, skeleton_id, bone_id):
+        """Return the row of the bone in forward_kinematics results."""
+        return self._bone_numbers[(skeleton_id, bone_id)]
+
+    def rigid_body_poses(self, frame):
+        """Return IDs (N), positions (N x 3) and orientations (N x 4) of
+        the rigid bodies of the frame."""
+        bodies = frame.rigid_bodies
+        n = len(bodies)
+        ids = self._buffers.get("rb_ids", n, 1, np.intp)[:, 0]
+        pos = self._buffers.get("rb_pos", n, 3)
+        ori = self._buffers.get("rb_ori", n, 4)
+        if n:
+            ids[:] = [rb.id for rb in bodies]
+            pos[:] = [rb.position for rb in bodies]
+            ori[:] = [rb.orientation for rb in bodies]
+        return ids, pos, ori
+
+    def _markers(self, frame):
+        """Return markers of all rigid bodies (M x 3) and the numbers of
+        their rigid bodies (M)."""
+        bodies = frame.rigid_bodies
+        counts = [len(rb.markers) for rb in bodies]
+        m = sum(counts)
+        markers = self._buffers.get("mrk", m, 3)
+        if m:
+            markers[:] = [mrk for rb in bodies for mrk in rb.markers]
+        owner = np.repeat(np.arange(len(bodies)), counts)
+        return markers, owner
+
+    def world_to_local(self, frame, points=None, owner=None, out=None):
+        """Transform points from world coordinates to the local frames of
+        the rigid bodies of the frame.
+
+        Arguments:
+          frame   FrameOfData
+          points  M x 3 world coordinates; markers of all rigid bodies
+                  of the frame by default
+          owner   the number of the rigid body in frame.rigid_bodies for
+                  every point; the owners of the markers by default
+          out     M x 3 array to store the result
+
+        Return the local coordinates and the owners.
+        """
+        if (points is None) != (owner is None):
+            raise ValueError("points and owner must be given together")
+        if points is None:
+            points, owner = self._markers(frame)
+        _, pos, ori = self.rigid_body_poses(frame)
+        if out is None:
+            out = self._buffers.get("local", len(points), 3)
+        inv = quat_conjugate(ori)
+        quat_rotate(inv[owner], np.subtract(points, pos[owner]), out=out)
+        return out, owner
+
+    def local_to_world(self, frame, points, owner, out=None):
+        """Transform points from the local frames of the rigid bodies of
+        the frame to world coordinates. See `world_to_local`."""
+        _, pos, ori = self.rigid_body_poses(frame)
+        if out is None:
+            out = self._buffers.get("world", len(points), 3)
+        quat_rotate(ori[owner], points, out=out)
+        out += pos[owner]
+        return out
+
+    def forward_kinematics(self, frame, offsets=True, out=None):
+        """Compose the bone poses of all skeletons of the frame into world
+        space.
+
+        Bone orientations of the frame are relative to the parent bones.
+        With `offsets`, a bone is placed at its ModelDefs offset from the
+        parent, otherwise at its position in the frame (relative to the
+        parent). Root bones keep their positions and orientations.
+
+        Arguments:
+          frame    FrameOfData
+          offsets  use bone offsets from ModelDefs
+          out      a pair of B x 3 and B x 4 arrays to store the result
+
+        Return world positions and orientations of the bones, in the
+        order of `bones` (see `bone_number`). Bones missing in the frame
+        are NaN.
+        """
+        nbones = len(self.bones)
+        lpos = self._buffers.get("fk_lpos", nbones, 3)
+        lori = self._buffers.get("fk_lori", nbones, 4)
+        if out is None:
+            out = (self._buffers.get("fk_pos", nbones, 3),
+                   self._buffers.get("fk_ori", nbones, 4))
+        wpos, wori = out
+        lpos.fill(np.nan)
+        lori.fill(np.nan)
+        numbers, poses = [], []
+        for sk in frame.skeletons:
+            for rb in sk.rigid_bodies:
+                # rigid body IDs of skeletons may have the skeleton ID in
+                # the high word
+                i = self._bone_numbers.get((sk.id, rb.id & 0xffff))
+                if i is not None:
+                    numbers.append(i)
+                    poses.append(rb.position + rb.orientation)
+        if numbers:
+            poses = np.array(poses, dtype=np.float64)
+            lpos[numbers] = poses[:, :3]
+            lori[numbers] = poses[:, 3:]
+        if offsets:
+            # only roots take the streamed position
+            trans = self._offsets
+        else:
+            trans = lpos
+        roots = self._roots
+        wpos[roots] = lpos[roots]
+        wori[roots] = lori[roots]
+        for idx, par in self._levels:
+            wori[idx] = quat_multiply(wori[par], lori[idx])
+            wpos[idx] = quat_rotate(wori[par], trans[idx])
+            wpos[idx] += wpos[par]
+        return wpos, wori
+
+
+###
+### Subscriptions and callback dispatch ###
+###
+
+
+# packet types by NatNet message ids
+PACKET_TYPES = { NAT_PINGRESPONSE: SenderData,
+                 NAT_FRAMEOFDATA: FrameOfData,
+                 NAT_MODELDEF: ModelDefs }
+
+
+class _Subscription(object):
+    """A callback registered with Dispatcher.
+
+    With an executor, at most one call of the callback is in progress at
+    a time; if new data arrive meanwhile, only the latest is kept and the
+    skipped ones are counted in `dropped`. Exceptions raised by the
+    callback, with or without an executor, are counted in `errors`, the
+    last one is kept in `error`; they never reach the receiving thread.
+    So are the exceptions of `executor.submit`, e.g. after the executor
+    is shut down; the data are then lost, but the next call is tried.
+    """
+
+    def __init__(self, key, callback, executor):
+        self.key = key
+        self.callback = callback
+        self.executor = executor
+        self.dropped = 0
+        self.errors = 0
+        self.error = None
+        self._lock = threading.Lock()
+        self._pending = None
+        self._running = False
+
+    def _call(self, args):
+        try:
+            self.callback(*args)
+        except Exception as e:
+            self.errors += 1
+            self.error = e
+
+    def deliver(self, args):
+        if self.executor is None:
+            self._call(args)
+            return
+        with self._lock:
+            if self._running:
+                if self._pending is not None:
+                    self.dropped += 1
+                self._pending = args
+                return
+            self._running = True
+        try:
+            self.executor.submit(self._run, args)
+        except Exception as e:
+            with self._lock:
+                self._running = False
+                self._pending = None
+            self.errors += 1
+            self.error = e
+
+    def _run(self, args):
+        while args is not None:
+            self._call(args)
+            with self._lock:
+                args, self._pending = self._pending, None
+                if args is None:
+                    self._running = False
+
+
+class Dispatcher(object):
+    """Route decoded packets to the callbacks subscribed to them.
+
+    >>> d = Dispatcher()
+    >>> s = d.subscribe(lambda p: print(p.natnet_version), message_type=SenderData)
+    >>> d.dispatch(SenderData("NatNetLib", (2,9,0,0), (2,9,0,0)))
+    (2, 9, 0, 0)
+
+    """
+
+    def __init__(self, executor=None):
+        """Keyword arguments:
+        executor -- if given, an object with a `submit(fn, *args)` method
+                    (e.g. concurrent.futures.ThreadPoolExecutor) to run
+                    callbacks; otherwise callbacks are called immediately
+                    in the thread which dispatches packets
+        """
+        self._executor = executor
+        self._lock = threading.Lock()
+        # dispatch table: key -> tuple of subscriptions; it is replaced,
+        # not modified, so that dispatch() may read it without locking
+        self._table = {}
+        self._needed = frozenset()
+
+    def subscribe(self, callback, message_type=None, rigid_body=None, skeleton=None):
+        """Register a callback. Exactly one of the keyword arguments is
+        required.
+
+        Keyword arguments:
+        message_type -- SenderData, ModelDefs or FrameOfData;
+                        callback(packet) is called for every such packet
+        rigid_body -- rigid body ID; callback(rigid_body, frame) is called
+                      for every FrameOfData with this rigid body
+        skeleton -- skeleton ID; callback(skeleton, frame) is called for
+                    every FrameOfData with this skeleton
+
+        Return a subscription to pass to `unsubscribe`.
+        """
+        given = [(k, v) for k, v in [("type", message_type),
+                                     ("rigid_body", rigid_body),
+                                     ("skeleton", skeleton)]
+                 if v is not None]
+        if len(given) != 1:
+            raise ValueError("exactly one of message_type, rigid_body, skeleton is required")
+        key = given[0]
+        if key[0] == "type" and key[1] not in PACKET_TYPES.values():
+            raise ValueError("unsupported message type: " + repr(message_type))
+        sub = _Subscription(key, callback, self._executor)
+        with self._lock:
+            table = dict(self._table)
+            table[key] = table.get(key, ()) + (sub,)
+            self._update(table)
+        return sub
+
+    def unsubscribe(self, subscription):
+        """Remove a callback registered with `subscribe`."""
+        with self._lock:
+            table = dict(self._table)
+            subs = tuple(s for s in table.get(subscription.key, ()) if s is not subscription)
+            if subs:
+                table[subscription.key] = subs
+            else:
+                table.pop(subscription.key, None)
+            self._update(table)
+
+    def _update(self, table):
+        needed = set()
+        for kind, value in table:
+            needed.add(value if kind == "type" else FrameOfData)
+        self._table = table
+        self._needed = frozenset(needed)
+
+    def needs(self, data):
+        """Return True if some subscriber needs the raw packet data,
+        i.e. it is worth to unpack them. Only the header is read."""
+        if not data or len(data) < 4:
+            return False
+        (msgtype,) = struct.unpack_from("=H", data)
+        return PACKET_TYPES.get(msgtype) in self._needed
+
+    def dispatch(self, packet):
+        """Pass an unpacked packet to the subscribed callbacks."""
+        table = self._table
+        for sub in table.get(("type", type(packet)), ()):
+            sub.deliver((packet,))
+        if type(packet) is not FrameOfData:
+            return
+        for rb in packet.rigid_bodies:
+            for sub in table.get(("rigid_body", rb.id), ()):
+                sub.deliver((rb, packet))
+        for skel in packet.skeletons:
+            for sub in table.get(("skeleton", skel.id), ()):
+                sub.deliver((skel, packet))
+
+
+###
+### Compact capture format ###
+###
+
+# A capture file is a header followed by independently compressed chunks.
+#
+# header:
+#  - magic (4 bytes, CAPTURE_MAGIC),
+#  - format version (unsigned char),
+#  - quantization steps of positions, orientations and sizes (3 doubles).
+# chunk:
+#  - compressed size (unsigned int),
+#  - first frame number (int),
+#  - number of frames (unsigned int),
+#  - zlib-compressed frame records.
+# frame record:
+#  - flags (unsigned char, CAPTURE_FLAG_*),
+#  - frame number minus the previous frame number (int),
+#  - timecode, timecode_sub (2 unsigned ints), latency (float),
+#  - timestamp (double), if CAPTURE_FLAG_TIMESTAMP,
+#  - layout, if CAPTURE_FLAG_LAYOUT:
+#     * number of ints and ints, number of bytes and utf-8 names of sets,
+#  - number of other markers, number of labeled markers (2 unsigned ints),
+#  - quantized values (zigzag-encoded, byte-shuffled unsigned ints),
+#  - escapes, if CAPTURE_FLAG_ESCAPES:
+#     * number of escapes (unsigned int),
+#     * value numbers (unsigned ints) and scaled values (doubles).
+#
+# Values of marker sets and rigid bodies are stored as deltas to the
+# previous frame, unless the layout is written; values of other and
+# labeled markers are stored as deltas if their counts did not change.
+# Deltas are modulo 2**32. Values which are not finite or do not fit
+# into int32 after scaling are quantized as CAPTURE_ESCAPE and stored
+# exactly (divided by the step) in the escapes.
+# The first frame of every chunk is a keyframe, it has a layout and no
+# deltas, so that every chunk may be decoded on its own.
+CAPTURE_MAGIC = b"ORXC"
+CAPTURE_HEADER_FORMAT = "<4sB3d"
+CAPTURE_CHUNK_FORMAT = "<IiI"
+CAPTURE_FRAME_FORMAT = "<BiIIf"
+
+CAPTURE_FLAG_LAYOUT =         0x01
+CAPTURE_FLAG_VAR_DELTA =      0x02
+CAPTURE_FLAG_TIMESTAMP =      0x04  # timestamp and flags are not None
+CAPTURE_FLAG_RECORDING =      0x08
+CAPTURE_FLAG_MODELS_CHANGED = 0x10
+CAPTURE_FLAG_LM_PARAMS =      0x20  # labeled markers have occluded etc.
+CAPTURE_FLAG_ESCAPES =        0x40
+
+CAPTURE_ESCAPE = -0x80000000
+
+# rigid body layout flags
+CAPTURE_RB_MARKER_DATA =      0x01  # mrk_ids, mrk_sizes, mrk_mean_error
+CAPTURE_RB_TRACKING_VALID =   0x02
+
+
+def _rigid_body_layout(rb):
+    flags = ((CAPTURE_RB_MARKER_DATA if rb.mrk_ids is not None else 0) |
+             (CAPTURE_RB_TRACKING_VALID if rb.tracking_valid is not None else 0))
+    return (rb.id, len(rb.markers), flags)
+
+
+def _frame_layout(frame):
+    """Return a hashable description of everything which does not change
+    in a stable scene: set names and sizes, rigid bodies and skeletons."""
+    return (tuple((name, len(markers)) for name, markers in frame.sets.items()),
+            tuple(_rigid_body_layout(rb) for rb in frame.rigid_bodies),
+            tuple((sk.id, tuple(_rigid_body_layout(rb) for rb in sk.rigid_bodies))
+                  for sk in frame.skeletons))
+
+
+def _pack_uints(values):
+    """Pack a list of unsigned ints with bytes grouped by significance."""
+    buf = struct.pack("<%dI" % len(values), *values)
+    return b"".join([buf[0::4], buf[1::4], buf[2::4], buf[3::4]])
+
+
+def _unpack_uints(data, n):
+    """Inverse of _pack_uints. Return a tuple and the rest of the data."""
+    buf = bytearray(4 * n)
+    for i in xrange(4):
+        buf[i::4] = data[i*n:(i+1)*n]
+    return struct.unpack("<%dI" % n, bytes(buf)), data[4*n:]
+
+
+def _wrap_int32(values):
+    "Reduce a list of ints modulo 2**32 to the int32 range, if necessary."
+    if values and (min(values) < -0x80000000 or max(values) > 0x7fffffff):
+        return [((v + 0x80000000) & 0xffffffff) - 0x80000000 for v in values]
+    return values
+
+
+def _zigzag(values):
+    return [((v << 1) ^ (v >> 31)) & 0xffffffff for v in _wrap_int32(values)]
+
+
+def _quantize_into(out, values, scale, escapes):
+    """Append values multiplied by scale and rounded to out. Values which
+    are not finite or do not fit into int32 are appended as CAPTURE_ESCAPE,
+    and (their number in out, scaled value) are appended to escapes."""
+    try:
+        q = [int(round(v * scale)) for v in values]
+        if not q or (min(q) > CAPTURE_ESCAPE and max(q) <= 0x7fffffff):
+            out.extend(q)
+            return
+    except (ValueError, OverflowError):
+        # NaN or infinity
+        pass
+    for v in values:
+        v *= scale
+        if -2147483647.0 < v < 2147483647.0:
+            out.append(int(round(v)))
+        else:
+            escapes.append((len(out), v))
+            out.append(CAPTURE_ESCAPE)
+
+
+def _unzigzag(values):
+    return [(z >> 1) ^ -(z & 1) for z in values]
+
+
+def _encode_layout(layout):
+    sets, bodies, skels = layout
+    ints = [len(sets)]
+    names = []
+    for name, nmarkers in sets:
+        name = name.encode("utf-8")
+        ints.extend((len(name), nmarkers))
+        names.append(name)
+    ints.append(len(bodies))
+    for rb in bodies:
+        ints.extend(rb)
+    ints.append(len(skels))
+    for skid, skbodies in skels:
+        ints.extend((skid, len(skbodies)))
+        for rb in skbodies:
+            ints.extend(rb)
+    names = b"".join(names)
+    return (struct.pack("<I%diI" % len(ints), len(ints), *(ints + [len(names)])) +
+            names)
+
+
+def _decode_layout(data):
+    (nints,), data = _unpack_head("<I", data)
+    ints, data = _unpack_head("<%diI" % nints, data)
+    nbytes = ints[-1]
+    names, data = data[:nbytes], data[nbytes:]
+    ints = iter(ints)
+    sets = []
+    for _ in xrange(next(ints)):
+        namelen, nmarkers = next(ints), next(ints)
+        sets.append((names[:namelen].decode("utf-8"), nmarkers))
+        names = names[namelen:]
+    bodies = tuple((next(ints), next(ints), next(ints)) for _ in xrange(next(ints)))
+    skels = []
+    for _ in xrange(next(ints)):
+        skid, nbodies = next(ints), next(ints)
+        skels.append((skid, tuple((next(ints), next(ints), next(ints))
+                                  for _ in xrange(nbodies))))
+    return (tuple(sets), bodies, tuple(skels)), data
+
+
+class CaptureWriter(object):
+    """Write FrameOfData packets to a compact capture file.
+
+    Positions, orientations and marker sizes are quantized with the given
+    steps and stored as deltas to the previous frame; the layout (set
+    names, rigid body and skeleton IDs, marker counts) is stored only when
+    it changes or when `tracked_models_changed` is set.
+    """
+
+    def __init__(self, fileobj, keyframe_interval=240, position_step=1e-5,
+                 orientation_step=1e-6, size_step=1e-5):
+        """Arguments:
+          fileobj            a binary file open for writing
+          keyframe_interval  number of frames per independently decodable chunk
+          position_step      quantization step of marker and body coordinates
+          orientation_step   quantization step of quaternion components
+          size_step          quantization step of marker sizes and errors
+        """
+        self._file = fileobj
+        self._interval = keyframe_interval
+        self._steps = (position_step, orientation_step, size_step)
+        self._file.write(struct.pack(CAPTURE_HEADER_FORMAT, CAPTURE_MAGIC, 1,
+                                     position_step, orientation_step, size_step))
+        self._records = []
+        self._first_frameno = None
+        self._prev_frameno = 0
+        self._prev_layout = None
+        self._prev_fixed = None
+        self._prev_var = None
+        self._prev_counts = None
+
+    def _quantize(self, frame):
+        """Return quantized fixed values, variable values, escapes of
+        both and labeled markers flag of the frame."""
+        pos, ori, size = [1.0 / step for step in self._steps]
+        fixed, fixed_escapes = [], []
+        for markers in frame.sets.values():
+            _quantize_into(fixed, [c for m in markers for c in m], pos, fixed_escapes)
+        for rb in frame.rigid_bodies + [rb for sk in frame.skeletons
+                                        for rb in sk.rigid_bodies]:
+            _quantize_into(fixed, rb.position, pos, fixed_escapes)
+            _quantize_into(fixed, rb.orientation, ori, fixed_escapes)
+            _quantize_into(fixed, [c for m in rb.markers for c in m], pos, fixed_escapes)
+            if rb.mrk_ids is not None:
+                fixed.extend(rb.mrk_ids)
+                _quantize_into(fixed, rb.mrk_sizes, size, fixed_escapes)
+                _quantize_into(fixed, (rb.mrk_mean_error,), size, fixed_escapes)
+            if rb.tracking_valid is not None:
+                fixed.append(int(rb.tracking_valid))
+        var, var_escapes = [], []
+        _quantize_into(var, [c for m in frame.other_markers for c in m], pos, var_escapes)
+        lm_params = bool(frame.labeled_markers) and frame.labeled_markers[0].occluded is not None
+        for lm in frame.labeled_markers:
+            var.append(lm.id)
+            _quantize_into(var, lm.position, pos, var_escapes)
+            _quantize_into(var, (lm.size,), size, var_escapes)
+            if lm_params:
+                var.append(lm.occluded | (lm.point_cloud_solved << 1) |
+                           (lm.model_solved << 2))
+        escapes = fixed_escapes + [(i + len(fixed), v) for i, v in var_escapes]
+        return fixed, var, escapes, lm_params
+
+    def write(self, frame):
+        """Append a FrameOfData to the capture."""
+        if len(self._records) >= self._interval:
+            self.flush()
+        if self._first_frameno is None:
+            self._first_frameno = frame.frameno
+        layout = _frame_layout(frame)
+        fixed, var, escapes, lm_params = self._quantize(frame)
+        counts = (len(frame.other_markers), len(frame.labeled_markers))
+        flags = 0
+        if self._prev_layout is None or frame.tracked_models_changed or layout != self._prev_layout:
+            flags |= CAPTURE_FLAG_LAYOUT
+            fixed_out = fixed
+        else:
+            fixed_out = [v - p for v, p in zip(fixed, self._prev_fixed)]
+        if self._prev_counts == counts:
+            flags |= CAPTURE_FLAG_VAR_DELTA
+            var_out = [v - p for v, p in zip(var, self._prev_var)]
+        else:
+            var_out = var
+        if frame.timestamp is not None:
+            flags |= CAPTURE_FLAG_TIMESTAMP
+            flags |= CAPTURE_FLAG_RECORDING if frame.is_recording else 0
+            flags |= CAPTURE_FLAG_MODELS_CHANGED if frame.tracked_models_changed else 0
+        if lm_params:
+            flags |= CAPTURE_FLAG_LM_PARAMS
+        if escapes:
+            flags |= CAPTURE_FLAG_ESCAPES
+        parts = [struct.pack(CAPTURE_FRAME_FORMAT, flags,
+                             frame.frameno - self._prev_frameno,
+                             frame.timecode[0], frame.timecode[1], frame.latency)]
+        if flags & CAPTURE_FLAG_TIMESTAMP:
+            parts.append(struct.pack("<d", frame.timestamp))
+        if flags & CAPTURE_FLAG_LAYOUT:
+            parts.append(_encode_layout(layout))
+        parts.append(struct.pack("<2I", *counts))
+        parts.append(_pack_uints(_zigzag(fixed_out + var_out)))
+        if escapes:
+            nums, values = zip(*escapes)
+            parts.append(struct.pack("<I%dI%dd" % (len(nums), len(nums)),
+                                     len(nums), *(nums + values)))
+        self._records.append(b"".join(parts))
+        self._prev_frameno = frame.frameno
+        self._prev_layout = layout
+        self._prev_fixed = fixed
+        self._prev_var = var
+        self._prev_counts = counts
+
+    def flush(self):
+        """Write buffered frames as a chunk. The next frame is a keyframe."""
+        if not self._records:
+            return
+        payload = zlib.compress(b"".join(self._records))
+        self._file.write(struct.pack(CAPTURE_CHUNK_FORMAT, len(payload),
+                                     self._first_frameno, len(self._records)))
+        self._file.write(payload)
+        self._records = []
+        self._first_frameno = None
+        self._prev_frameno = 0
+        self._prev_layout = None
+        self._prev_counts = None
+
+    def close(self):
+        """Write buffered frames. The file object is not closed."""
+        self.flush()
+
+
+class CaptureReader(object):
+    """Read FrameOfData packets from a capture file written by CaptureWriter.
+
+    Chunk headers are scanned on open, so that `seek` decodes only the
+    chunk which contains the requested frame. A chunk cut short, e.g. when
+    the writer was killed, and everything after it are ignored.
+    """
+
+    def __init__(self, fileobj):
+        """Arguments:
+          fileobj  a seekable binary file open for reading
+        """
+        self._file = fileobj
+        head = fileobj.read(struct.calcsize(CAPTURE_HEADER_FORMAT))
+        magic, fmtversion, pos, ori, size = struct.unpack(CAPTURE_HEADER_FORMAT, head)
+        if magic != CAPTURE_MAGIC or fmtversion != 1:
+            raise ValueError("not a capture file")
+        self._steps = (pos, ori, size)
+        # chunk index: (offset of the compressed data, first frameno, nframes)
+        self._chunks = []
+        chunk_size = struct.calcsize(CAPTURE_CHUNK_FORMAT)
+        offset = fileobj.tell()
+        fileobj.seek(0, 2)
+        filesize = fileobj.tell()
+        fileobj.seek(offset)
+        while True:
+            head = fileobj.read(chunk_size)
+            if len(head) < chunk_size:
+                break
+            nbytes, first, nframes = struct.unpack(CAPTURE_CHUNK_FORMAT, head)
+            offset = fileobj.tell()
+            if offset + nbytes > filesize:
+                break
+            self._chunks.append((offset, nbytes, first, nframes))
+            fileobj.seek(nbytes, 1)
+        self._chunkno = 0
+        self._frames = []
+        self._frameidx = 0
+
+    def __len__(self):
+        return sum(c[3] for c in self._chunks)
+
+    def __iter__(self):
+        while True:
+            frame = self.read()
+            if frame is None:
+                return
+            yield frame
+
+    def read(self):
+        """Return the next FrameOfData or None at the end of the capture."""
+        while self._frameidx >= len(self._frames):
+            if self._chunkno >= len(self._chunks):
+                return None
+            self._frames = self._decode_chunk(self._chunkno)
+            self._frameidx = 0
+            self._chunkno += 1
+        frame = self._frames[self._frameidx]
+        self._frameidx += 1
+        return frame
+
+    def seek(self, frameno):
+        """Continue reading at the first frame with the number not less
+        than `frameno`."""
+        chunkno = 0
+        for i, (_, _, first, _) in enumerate(self._chunks):
+            if first <= frameno:
+                chunkno = i
+        self._chunkno = chunkno
+        self._frames = []
+        self._frameidx = 0
+        while True:
+            frame = self.read()
+            if frame is None or frame.frameno >= frameno:
+                break
+        if frame is not None:
+            self._frameidx -= 1
+
+    def _decode_chunk(self, chunkno):
+        offset, nbytes, _, nframes = self._chunks[chunkno]
+        self._file.seek(offset)
+        data = zlib.decompress(self._file.read(nbytes))
+        frames = []
+        frameno, layout, nfixed, fixed, var = 0, None, 0, None, None
+        for _ in xrange(nframes):
+            (flags, dframeno, tc, tcsub, latency), data = _unpack_head(CAPTURE_FRAME_FORMAT, data)
+            frameno += dframeno
+            timestamp = None
+            if flags & CAPTURE_FLAG_TIMESTAMP:
+                (timestamp,), data = _unpack_head("<d", data)
+            if flags & CAPTURE_FLAG_LAYOUT:
+                layout, data = _decode_layout(data)
+                nfixed = self._count_fixed(layout)
+            counts, data = _unpack_head("<2I", data)
+            nvar = 3 * counts[0] + counts[1] * (6 if flags & CAPTURE_FLAG_LM_PARAMS else 5)
+            values, data = _unpack_uints(data, nfixed + nvar)
+            values = _unzigzag(values)
+            if flags & CAPTURE_FLAG_LAYOUT:
+                fixed = values[:nfixed]
+            else:
+                fixed = _wrap_int32([v + p for v, p in zip(values[:nfixed], fixed)])
+            if flags & CAPTURE_FLAG_VAR_DELTA:
+                var = _wrap_int32([v + p for v, p in zip(values[nfixed:], var)])
+            else:
+                var = values[nfixed:]
+            frame_fixed, frame_var = fixed, var
+            if flags & CAPTURE_FLAG_ESCAPES:
+                (nescapes,), data = _unpack_head("<I", data)
+                escapes, data = _unpack_head("<%dI%dd" % (nescapes, nescapes), data)
+                frame_fixed, frame_var = list(fixed), list(var)
+                for i, v in zip(escapes[:nescapes], escapes[nescapes:]):
+                    if i < nfixed:
+                        frame_fixed[i] = v
+                    else:
+                        frame_var[i - nfixed] = v
+            frames.append(self._make_frame(flags, frameno, (tc, tcsub), latency,
+                                           timestamp, layout, frame_fixed, frame_var,
+                                           counts))
+        return frames
+
+    @staticmethod
+    def _count_fixed(layout):
+        sets, bodies, skels = layout
+        n = 3 * sum(nmarkers for _, nmarkers in sets)
+        for _, nmarkers, flags in bodies + tuple(rb for _, sk in skels for rb in sk):
+            n += 7 + 3 * nmarkers
+            if flags & CAPTURE_RB_MARKER_DATA:
+                n += 2 * nmarkers + 1
+            if flags & CAPTURE_RB_TRACKING_VALID:
+                n += 1
+        return n
+
+    def _make_frame(self, flags, frameno, timecode, latency, timestamp,
+                    layout, fixed, var, counts):
+        pos, ori, size = self._steps
+        sets_layout, bodies_layout, skels_layout = layout
+        vals = iter(fixed)
+
+        def markers(n):
+            return [(next(vals) * pos, next(vals) * pos, next(vals) * pos)
+                    for _ in xrange(n)]
+
+        def rigid_body(rbid, nmarkers, rbflags):
+            position = (next(vals) * pos, next(vals) * pos, next(vals) * pos)
+            orientation = (next(vals) * ori, next(vals) * ori,
+                           next(vals) * ori, next(vals) * ori)
+            rbmarkers = markers(nmarkers)
+            mrk_ids, mrk_sizes, mrk_mean_error, tracking_valid = None, None, None, None
+            if rbflags & CAPTURE_RB_MARKER_DATA:
+                mrk_ids = tuple(next(vals) for _ in xrange(nmarkers))
+                mrk_sizes = tuple(next(vals) * size for _ in xrange(nmarkers))
+                mrk_mean_error = next(vals) * size
+            if rbflags & CAPTURE_RB_TRACKING_VALID:
+                tracking_valid = next(vals) == 1
+            return RigidBody(rbid, position, orientation, rbmarkers,
+                             mrk_ids, mrk_sizes, mrk_mean_error, tracking_valid)
+
+        sets = OrderedDict()
+        for name, nmarkers in sets_layout:
+            sets[name] = markers(nmarkers)
+        bodies = [rigid_body(*rb) for rb in bodies_layout]
+        skels = [Skeleton(skid, [rigid_body(*rb) for rb in skbodies])
+                 for skid, skbodies in skels_layout]
+        vals = iter(var)
+        other_markers = markers(counts[0])
+        lmarkers = []
+        for _ in xrange(counts[1]):
+            lmid = next(vals)
+            position = (next(vals) * pos, next(vals) * pos, next(vals) * pos)
+            lmsize = next(vals) * size
+            if flags & CAPTURE_FLAG_LM_PARAMS:
+                params = next(vals)
+                lmarkers.append(LabeledMarker(lmid, position, lmsize, params & 0x01 == 1,
+                                              params & 0x02 == 2, params & 0x04 == 4))
+            else:
+                lmarkers.append(LabeledMarker(lmid, position, lmsize, None, None, None))
+        has_flags = flags & CAPTURE_FLAG_TIMESTAMP
+        return FrameOfData(frameno=frameno,
+                           sets=sets,
+                           other_markers=other_markers,
+                           rigid_bodies=bodies,
+                           skeletons=skels,
+                           labeled_markers=lmarkers,
+                           latency=latency,
+                           timecode=timecode,
+                           timestamp=timestamp,
+                           is_recording=bool(flags & CAPTURE_FLAG_RECORDING) if has_flags else None,
+                           tracked_models_changed=bool(flags & CAPTURE_FLAG_MODELS_CHANGED) if has_flags else None)
+
+
 ###
 ### Communication sockets ###
 ###
@@ -468,15 +1857,18 @@ def mkdatasock(ip_address=None, multicast_address=MULTICAST_ADDRESS, port=PORT_D
 class DataThread(threading.Thread):
     def __init__(self, ip_address=None, multicast_address=MULTICAST_ADDRESS,
                  port=PORT_DATA, version=(2, 5, 0, 0), packet_limit=500,
-                 *args, **kwargs):
+                 dispatcher=None, *args, **kwargs):
         """Thread used to continually pull data from the data socket.
 
         Keyword arguments:
         ip_address -- the IP address passed to `mkdatasock`
         multicast_address -- the multicast address passed to `mkdatasock`
         port -- the data port passed to `mkdatasock`
-        version -- the NatNetSDK version tuple passed to `unpack`
+        version -- the initial NatNetSDK version tuple of the FrameDecoder
         packet_limit -- the number of packets to keep in the internal queue
+        dispatcher -- if given, a Dispatcher to pass packets to instead of
+                      the internal queue; packets nobody subscribed to
+                      are not unpacked
         """
         super(DataThread, self).__init__(*args, **kwargs)
 
@@ -492,7 +1884,8 @@ class DataThread(threading.Thread):
         self._packet_available = threading.Event()
         self._packet_limit = packet_limit
 
-        self._version = version
+        self._decoder = FrameDecoder(version)
+        self._dispatcher = dispatcher
 
     def cancel(self):
         self._stop.set()
@@ -508,6 +1901,18 @@ class DataThread(threading.Thread):
             ret = []
         return ret
 
+    def _process(self, data):
+        if self._dispatcher:
+            # SenderData is always unpacked to update the version
+            if self._dispatcher.needs(data) or data[:2] == struct.pack("=H", NAT_PINGRESPONSE):
+                self._dispatcher.dispatch(self._decoder.unpack(data))
+        else:
+            packet = self._decoder.unpack(data)
+            with self._packet_lock:
+                self._packet_buf.append(packet)
+                self._packet_buf = self._packet_buf[-self._packet_limit:]
+            self._packet_available.set()
+
     def run(self):
         while not self._stop.is_set():
             try:
@@ -515,11 +1920,241 @@ class DataThread(threading.Thread):
             except socket.error:
                 # Thrown when recv finds no data (non-blocking mode)
                 sleep(0.1)
+                continue
+            self._process(data)
+        self._socket.close()
+
+
+
+# SourcePacket: a packet received by MultiSourceThread
+#   source is a (multicast_address, port) tuple
+#   packet is SenderData, ModelDefs or FrameOfData
+SourcePacket = namedtuple("SourcePacket", "source packet")
+
+
+# SourceStats: per-source counters of MultiSourceThread
+#   packets is the number of received datagrams
+#   nbytes is the total size of received datagrams
+#   errors is the number of datagrams which could not be unpacked
+#   frames is the number of FrameOfData packets
+#   dropped_frames is the number of frame numbers skipped by the sender
+#   last_frameno is the number of the last FrameOfData or None
+SourceStats = namedtuple("SourceStats", "packets nbytes errors frames dropped_frames last_frameno")
+
+
+class _Source(object):
+    """Receiving state of one NatNet data source."""
+
+    def __init__(self, key, sock, version, dispatcher=None):
+        self.key = key
+        self.sock = sock
+        self.decoder = FrameDecoder(version)
+        self.dispatcher = dispatcher
+        self.stats = SourceStats(packets=0, nbytes=0, errors=0, frames=0,
+                                 dropped_frames=0, last_frameno=None)
+
+    @property
+    def version(self):
+        return self.decoder.version
+
+    def unpack(self, data):
+        """Unpack a datagram and update version and stats of the source.
+        Return the unpacked packet or None.
+
+        If the source has a dispatcher, packets which nobody subscribed to
+        are not unpacked (except SenderData, to track the version).
+        """
+        stats = self.stats
+        stats = stats._replace(packets=stats.packets + 1,
+                               nbytes=stats.nbytes + len(data))
+        msgtype = None
+        if len(data) >= 4:
+            (msgtype,) = struct.unpack_from("=H", data)
+        if (self.dispatcher and msgtype != NAT_PINGRESPONSE and
+                not self.dispatcher.needs(data)):
+            if msgtype == NAT_FRAMEOFDATA and len(data) >= 8:
+                # frame number is at the head of the payload
+                (frameno,) = struct.unpack_from("=i", data, 4)
+                stats = self._count_frame(stats, frameno)
+            self.stats = stats
+            return None
+        try:
+            packet = self.decoder.unpack(data)
+        except (NotImplementedError, AssertionError, struct.error):
+            self.stats = stats._replace(errors=stats.errors + 1)
+            return None
+        if type(packet) is FrameOfData:
+            stats = self._count_frame(stats, packet.frameno)
+        self.stats = stats
+        return packet
+
+    @staticmethod
+    def _count_frame(stats, frameno):
+        dropped = stats.dropped_frames
+        if stats.last_frameno is not None and frameno > stats.last_frameno + 1:
+            dropped += frameno - stats.last_frameno - 1
+        return stats._replace(frames=stats.frames + 1,
+                              dropped_frames=dropped,
+                              last_frameno=frameno)
+
+
+class MultiSourceThread(threading.Thread):
+    def __init__(self, ip_address=None, packet_limit=500, recv_batch=32,
+                 *args, **kwargs):
+        """Thread used to pull data from several data sockets at once.
+
+        All sources are polled by a single selector loop, so adding a
+        source does not add a thread. Received packets are tagged with
+        their source as SourcePacket tuples.
+
+        Keyword arguments:
+        ip_address -- the IP address passed to `mkdatasock`
+        packet_limit -- the number of packets to keep in the internal queue
+        recv_batch -- the maximal number of datagrams to read from one
+                      source per poll, so that a busy source does not
+                      starve the others
+        """
+        super(MultiSourceThread, self).__init__(*args, **kwargs)
+
+        self._stop_event = threading.Event()
+
+        self._ip_address = ip_address
+        self._recv_batch = recv_batch
+        self._sources = {}
+        self._sources_lock = threading.Lock()
+        if selectors:
+            self._selector = selectors.DefaultSelector()
+        else:
+            self._selector = None
+
+        self._packet_buf = []
+        self._packet_lock = threading.Lock()
+        self._packet_available = threading.Event()
+        self._packet_limit = packet_limit
+
+    def add_source(self, multicast_address=MULTICAST_ADDRESS, port=PORT_DATA,
+                   version=(2, 5, 0, 0), dispatcher=None):
+        """Start receiving data from a multicast group.
+
+        Keyword arguments:
+        multicast_address -- the multicast address passed to `mkdatasock`
+        port -- the data port passed to `mkdatasock`
+        version -- the initial NatNetSDK version tuple of the source's
+                   FrameDecoder; it is updated whenever the source sends
+                   SenderData
+        dispatcher -- if given, a Dispatcher to pass packets of this source
+                      to instead of the internal queue
+
+        Every source needs its own port: data sockets are bound to the
+        port on all interfaces, so sources on the same port would receive
+        each other's packets.
+
+        Return the source key, a (multicast_address, port) tuple.
+        """
+        key = (multicast_address, port)
+        with self._sources_lock:
+            if any(p == port for _, p in self._sources):
+                raise ValueError("a source is already registered on port %d" % port)
+            sock = mkdatasock(ip_address=self._ip_address,
+                              multicast_address=multicast_address,
+                              port=port)
+            sock.setblocking(0)
+            source = _Source(key, sock, version, dispatcher)
+            self._sources[key] = source
+            if self._selector:
+                self._selector.register(sock, selectors.EVENT_READ, source)
+        return key
+
+    def remove_source(self, key):
+        """Stop receiving data from the source and close its socket."""
+        with self._sources_lock:
+            source = self._sources.pop(key)
+            if self._selector:
+                self._selector.unregister(source.sock)
+            source.sock.close()
+
+    def sources(self):
+        """Return a list of registered source keys."""
+        with self._sources_lock:
+            return list(self._sources.keys())
+
+    def get_version(self, key):
+        """Return the current NatNet version of the source."""
+        with self._sources_lock:
+            return self._sources[key].version
+
+    def get_stats(self, key):
+        """Return SourceStats of the source."""
+        with self._sources_lock:
+            return self._sources[key].stats
+
+    def cancel(self):
+        self._stop_event.set()
+
+    def get_packets(self):
+        """Returns a list of all SourcePackets seen so far."""
+        if self._packet_available.wait(timeout=0.1):
+            with self._packet_lock:
+                ret = self._packet_buf[:]
+                self._packet_buf = []
+                self._packet_available.clear()
+        else:
+            ret = []
+        return ret
+
+    def _poll(self, timeout):
+        """Wait until some sockets are readable. Return their sources."""
+        if self._selector:
+            with self._sources_lock:
+                empty = not self._sources
+            if empty:
+                sleep(timeout)
+                return []
+            return [k.data for k, _ in self._selector.select(timeout)]
+        else:
+            with self._sources_lock:
+                by_sock = dict((s.sock, s) for s in self._sources.values())
+            if not by_sock:
+                sleep(timeout)
+                return []
+            try:
+                readable, _, _ = select.select(list(by_sock.keys()), [], [], timeout)
+            except (select.error, socket.error, ValueError):
+                # a socket was closed by remove_source() meanwhile
+                return []
+            return [by_sock[s] for s in readable]
+
+    def _receive(self, source):
+        """Read up to recv_batch datagrams from the socket of the source.
+        Return a list of SourcePackets."""
+        packets = []
+        for _ in xrange(self._recv_batch):
+            try:
+                data = source.sock.recv(MAX_PACKETSIZE)
+            except socket.error:
+                # no more data (non-blocking mode) or the socket was closed
+                break
+            with self._sources_lock:
+                packet = source.unpack(data)
+            if packet is None:
+                continue
+            if source.dispatcher:
+                source.dispatcher.dispatch(packet)
             else:
-                packet = unpack(data, version=self._version)
+                packets.append(SourcePacket(source.key, packet))
+        return packets
+
+    def run(self):
+        while not self._stop_event.is_set():
+            packets = []
+            for source in self._poll(0.1):
+                packets.extend(self._receive(source))
+            if packets:
                 with self._packet_lock:
-                    self._packet_buf.append(packet)
+                    self._packet_buf.extend(packets)
                     self._packet_buf = self._packet_buf[-self._packet_limit:]
                 self._packet_available.set()
-        self._socket.close()
-
+        for key in self.sources():
+            self.remove_source(key)
+        if self._selector:
+            self._selector.close()
@@ -38,4 +38,5 @@ setup(name='optirx',
                      "Programming Language :: Python :: 3.3",
                      "Programming Language :: Python :: 3.4",
                      "Topic :: Software Development :: Libraries" ],
-      py_modules = ['optirx'])
+      py_modules = ['optirx'],
+      extras_require = {'numpy': ['numpy']})
@@ -0,0 +1,121 @@
+from __future__ import print_function
+import io
+from nose.tools import assert_equal, assert_is
+
+
+import optirx as rx
+from test_unpack import assert_almost_equal
+
+
+FILES = [("test/data/frame-motive-1.5.0-%03d.bin", (2,5,0,0)),
+         ("test/data/frame-motive-1.7.2-%03d.bin", (2,7,0,0)),
+         ("test/data/frame-motive-1.9.0-%03d.bin", (2,9,0,0))]
+
+
+def _frames(pattern, version):
+    frames = []
+    for i in range(1,1+2):
+        with open(pattern % i, "rb") as f:
+            frames.append(rx.unpack(f.read(), version))
+    return frames
+
+
+def _capture(frames, **kwargs):
+    buf = io.BytesIO()
+    writer = rx.CaptureWriter(buf, **kwargs)
+    for frame in frames:
+        writer.write(frame)
+    writer.close()
+    return io.BytesIO(buf.getvalue())
+
+
+def test_capture_round_trip_all_versions():
+    for pattern, version in FILES:
+        frames = _frames(pattern, version)
+        reader = rx.CaptureReader(_capture(frames))
+        assert_equal(len(reader), len(frames))
+        for expected, actual in zip(frames, reader):
+            print("expected:\n", expected)
+            print("actual:\n", actual)
+            assert_is(type(actual), rx.FrameOfData)
+            assert_equal(actual.frameno, expected.frameno)
+            assert_equal(actual.timecode, expected.timecode)
+            assert_equal(actual.timestamp, expected.timestamp)
+            assert_equal(actual.is_recording, expected.is_recording)
+            assert_equal(actual.tracked_models_changed, expected.tracked_models_changed)
+            assert_almost_equal(actual.latency, expected.latency, 5)
+            assert_equal(sorted(actual.sets), sorted(expected.sets))
+            for name in expected.sets:
+                assert_almost_equal(actual.sets[name], expected.sets[name], 4)
+            assert_almost_equal(actual.other_markers, expected.other_markers, 4)
+            assert_equal(len(actual.rigid_bodies), len(expected.rigid_bodies))
+            for a, e in zip(actual.rigid_bodies, expected.rigid_bodies):
+                assert_equal(a.id, e.id)
+                assert_almost_equal(a.position, e.position, 4)
+                assert_almost_equal(a.orientation, e.orientation, 5)
+                assert_almost_equal(a.markers, e.markers, 4)
+                assert_equal(a.mrk_ids, e.mrk_ids)
+                assert_equal(a.tracking_valid, e.tracking_valid)
+            assert_equal([(m.id, m.occluded, m.model_solved) for m in actual.labeled_markers],
+                         [(m.id, m.occluded, m.model_solved) for m in expected.labeled_markers])
+
+
+def test_capture_seek_and_layout_change():
+    pattern, version = FILES[-1]
+    frame = _frames(pattern, version)[0]
+    frames = []
+    for i in range(10):
+        f = frame._replace(frameno=frame.frameno + i)
+        if i >= 5:  # a rigid body is removed from the scene
+            f = f._replace(rigid_bodies=[], tracked_models_changed=(i == 5))
+        frames.append(f)
+    reader = rx.CaptureReader(_capture(frames, keyframe_interval=3))
+    assert_equal([len(f.rigid_bodies) for f in reader], [1] * 5 + [0] * 5)
+    reader.seek(frame.frameno + 7)
+    assert_equal(reader.read().frameno, frame.frameno + 7)
+    reader.seek(frame.frameno + 4)
+    assert_equal([f.frameno - frame.frameno for f in reader], [4, 5, 6, 7, 8, 9])
+    reader.seek(frame.frameno + 100)
+    assert_is(reader.read(), None)
+
+
+def test_capture_escapes_nan_and_out_of_range_values():
+    pattern, version = FILES[-1]
+    frame = _frames(pattern, version)[0]
+    rb = frame.rigid_bodies[0]
+    nan = float("nan")
+    frames = [frame,
+              # not finite
+              frame._replace(frameno=frame.frameno + 1,
+                             rigid_bodies=[rb._replace(position=(nan, 1.0, float("inf")))],
+                             other_markers=[(nan, nan, nan)]),
+              # out of int32 range after quantization
+              frame._replace(frameno=frame.frameno + 2,
+                             rigid_bodies=[rb._replace(position=(30000.0, -1e8, 0.5))],
+                             other_markers=[(30000.0, 0.0, 0.0)]),
+              # in range, but deltas to the previous frame are not
+              frame._replace(frameno=frame.frameno + 3,
+                             rigid_bodies=[rb._replace(position=(-20000.0, 20000.0, 0.5))]),
+              frame._replace(frameno=frame.frameno + 4,
+                             rigid_bodies=[rb._replace(position=(20000.0, -20000.0, 0.5))])]
+    actual = list(rx.CaptureReader(_capture(frames)))
+    assert_equal(len(actual), len(frames))
+    x, y, z = actual[1].rigid_bodies[0].position
+    assert x != x and y == 1.0 and z == float("inf"), (x, y, z)
+    assert all(c != c for c in actual[1].other_markers[0])
+    assert_almost_equal(actual[2].rigid_bodies[0].position, (30000.0, -1e8, 0.5), 4)
+    assert_almost_equal(actual[2].other_markers, [(30000.0, 0.0, 0.0)], 4)
+    assert_almost_equal(actual[3].rigid_bodies[0].position, (-20000.0, 20000.0, 0.5), 4)
+    assert_almost_equal(actual[4].rigid_bodies[0].position, (20000.0, -20000.0, 0.5), 4)
+    # escapes do not leak into the following frames
+    assert_almost_equal(actual[3].rigid_bodies[0].markers, rb.markers, 4)
+
+
+def test_capture_truncated_file():
+    pattern, version = FILES[-1]
+    frame = _frames(pattern, version)[0]
+    frames = [frame._replace(frameno=frame.frameno + i) for i in range(10)]
+    data = _capture(frames, keyframe_interval=4).getvalue()
+    reader = rx.CaptureReader(io.BytesIO(data[:-10]))  # the last chunk is cut
+    assert_equal(len(reader), 8)
+    assert_equal([f.frameno - frame.frameno for f in reader], list(range(8)))
@@ -0,0 +1,120 @@
+from __future__ import print_function
+import threading
+from nose.tools import assert_equal, assert_false, assert_is, assert_true
+
+
+import optirx as rx
+
+
+def _read(fname):
+    with open(fname, "rb") as f:
+        return f.read()
+
+
+class ThreadExecutor(object):
+    "Run every submitted call in a new thread."
+
+    def __init__(self):
+        self.threads = []
+
+    def submit(self, fn, *args):
+        t = threading.Thread(target=fn, args=args)
+        t.start()
+        self.threads.append(t)
+
+
+def test_dispatch_by_message_type_and_rigid_body():
+    sender_data = _read("test/data/frame-motive-1.9.0-000.bin")
+    frame_data = _read("test/data/frame-motive-1.9.0-001.bin")
+    d = rx.Dispatcher()
+    assert_false(d.needs(sender_data))
+    assert_false(d.needs(frame_data))
+
+    senders, bodies, others = [], [], []
+    d.subscribe(senders.append, message_type=rx.SenderData)
+    assert_true(d.needs(sender_data))
+    assert_false(d.needs(frame_data))
+    sub = d.subscribe(lambda rb, frame: bodies.append((rb.id, frame.frameno)),
+                      rigid_body=2)
+    d.subscribe(lambda rb, frame: others.append(rb), rigid_body=42)
+    assert_true(d.needs(frame_data))
+
+    for data in [sender_data, frame_data]:
+        d.dispatch(rx.unpack(data, (2, 9, 0, 0)))
+    assert_equal(len(senders), 1)
+    assert_is(type(senders[0]), rx.SenderData)
+    assert_equal(bodies, [(2, 11823217)])
+    assert_equal(others, [])
+
+    d.unsubscribe(sub)
+    d.dispatch(rx.unpack(frame_data, (2, 9, 0, 0)))
+    assert_equal(len(bodies), 1)
+
+
+def test_slow_callback_does_not_block_dispatch():
+    executor = ThreadExecutor()
+    d = rx.Dispatcher(executor=executor)
+    release = threading.Event()
+    seen = []
+
+    def slow(packet):
+        release.wait(5)
+        seen.append(packet)
+
+    sub = d.subscribe(slow, message_type=rx.SenderData)
+    packets = [rx.SenderData("app", (2, 9, 0, i), (2, 9, 0, i)) for i in range(4)]
+    for p in packets:
+        d.dispatch(p)  # returns while the first call is still waiting
+    release.set()
+    for t in executor.threads:
+        t.join(5)
+    # the first and the latest packets are delivered, the rest are dropped
+    assert_equal(seen, [packets[0], packets[-1]])
+    assert_equal(sub.dropped, 2)
+    assert_equal(len(executor.threads), 1)
+
+
+def test_failing_callback_does_not_stop_dispatch():
+    for executor in [None, ThreadExecutor()]:
+        d = rx.Dispatcher(executor=executor)
+        seen = []
+        failing = d.subscribe(lambda packet: 1 / 0, message_type=rx.SenderData)
+        d.subscribe(seen.append, message_type=rx.SenderData)
+        packet = rx.SenderData("app", (2, 9, 0, 0), (2, 9, 0, 0))
+        d.dispatch(packet)
+        d.dispatch(packet)
+        for t in getattr(executor, "threads", []):
+            t.join(5)
+        assert_equal(seen, [packet, packet])
+        assert_equal(failing.errors, 2)
+        assert_is(type(failing.error), ZeroDivisionError)
+
+
+class ShutdownExecutor(ThreadExecutor):
+    "Refuse new calls like an executor that has been shut down."
+
+    def __init__(self):
+        ThreadExecutor.__init__(self)
+        self.shutdown = True
+
+    def submit(self, fn, *args):
+        if self.shutdown:
+            raise RuntimeError("cannot schedule new futures after shutdown")
+        ThreadExecutor.submit(self, fn, *args)
+
+
+def test_failing_submit_does_not_stop_dispatch():
+    executor = ShutdownExecutor()
+    d = rx.Dispatcher(executor=executor)
+    seen = []
+    sub = d.subscribe(seen.append, message_type=rx.SenderData)
+    packet = rx.SenderData("app", (2, 9, 0, 0), (2, 9, 0, 0))
+    d.dispatch(packet)  # does not raise
+    assert_equal(sub.errors, 1)
+    assert_is(type(sub.error), RuntimeError)
+    assert_false(sub._running)
+    executor.shutdown = False
+    d.dispatch(packet)
+    for t in executor.threads:
+        t.join(5)
+    assert_equal(seen, [packet])
@@ -0,0 +1,92 @@
+from __future__ import print_function
+import struct
+from nose.tools import assert_equal, assert_is
+
+
+import optirx as rx
+
+
+FILES = [("test/data/frame-motive-1.5.0-%03d.bin", (2,5,0,0)),
+         ("test/data/frame-motive-1.7.2-%03d.bin", (2,7,0,0)),
+         ("test/data/frame-motive-1.9.0-%03d.bin", (2,9,0,0))]
+
+
+def _read(fname):
+    with open(fname, "rb") as f:
+        return f.read()
+
+
+def test_planned_frames_equal_generic_all_versions():
+    for pattern, version in FILES:
+        frames = [_read(pattern % i) for i in range(1,1+2)]
+        decoder = rx.FrameDecoder(version)
+        for data in frames + frames:
+            assert_equal(decoder.unpack(data), rx.unpack(data, version))
+        # the plan is learned once the layout repeats
+        assert_equal(decoder.unplanned, 2)
+        assert_equal(decoder.planned, 2)
+
+
+def test_plan_rejects_other_layout():
+    frame = rx.unpack(_read("test/data/frame-motive-1.7.2-001.bin"), (2,7,0,0))
+    plan = rx.FramePlan(frame, (2,7,0,0))
+    # the same version, but another set name and rigid body
+    data = _read("test/data/frame-motive-1.9.0-001.bin")
+    assert_is(plan.unpack(data), None)
+
+
+def test_decoder_falls_back_when_tracked_models_changed():
+    data = _read("test/data/frame-motive-1.9.0-001.bin")
+    decoder = rx.FrameDecoder((2,9,0,0))
+    decoder.unpack(data)
+    # params (short) are followed by the end-of-data tag (int)
+    changed = bytearray(data)
+    changed[-6] |= 0x02
+    changed = bytes(changed)
+    frame = decoder.unpack(changed)
+    assert_equal(frame.tracked_models_changed, True)
+    assert_equal(decoder.planned, 0)
+    assert_is(decoder.plan, None)
+    for _ in range(3):
+        decoder.unpack(data)
+    assert_equal(decoder.planned, 1)
+
+
+def test_decoder_tracks_version():
+    decoder = rx.FrameDecoder()
+    decoder.unpack(_read("test/data/frame-motive-1.9.0-000.bin"))
+    assert_equal(decoder.version, (2,9,0,0))
+    frame = decoder.unpack(_read("test/data/frame-motive-1.9.0-001.bin"))
+    assert_equal(frame, rx.unpack(_read("test/data/frame-motive-1.9.0-001.bin"), (2,9,0,0)))
+
+
+def test_plan_keeps_set_order_of_the_packet():
+    for pattern, version in FILES:
+        data = _read(pattern % 1)
+        frame = rx.unpack(data, version)
+        # marker sets follow the frame number and the number of sets
+        names, offset = [], 12
+        for _ in range(len(frame.sets)):
+            end = data.index(b"\0", offset)
+            names.append(data[offset:end].decode("utf-8"))
+            (nmarkers,) = struct.unpack_from("=i", data, end + 1)
+            offset = end + 5 + 12 * nmarkers
+        assert_equal(list(frame.sets), names)
+        decoder = rx.FrameDecoder(version)
+        decoder.unpack(data)
+        decoder.unpack(data)
+        assert_equal(list(decoder.unpack(data).sets), names)
+        assert_equal(decoder.planned, 1)
+
+
+def test_decoder_does_not_relearn_changing_layouts():
+    data = _read("test/data/frame-motive-1.9.0-001.bin")
+    other = data.replace(b"Triangle\0", b"Triangla\0")  # another set name
+    decoder = rx.FrameDecoder((2,9,0,0))
+    for d in [data, other] * 3:
+        assert_equal(decoder.unpack(d), rx.unpack(d, (2,9,0,0)))
+        assert_is(decoder.plan, None)
+    assert_equal(decoder.unplanned, 6)
+    decoder.unpack(other)
+    decoder.unpack(other)
+    assert_equal(decoder.planned, 1)
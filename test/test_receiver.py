@@ -0,0 +1,196 @@
+from __future__ import print_function
+import select
+import socket
+import time
+from unittest import SkipTest
+from nose.tools import assert_equal, assert_false, assert_is, assert_raises
+
+
+import optirx as rx
+
+
+def _read(fname):
+    with open(fname, "rb") as f:
+        return f.read()
+
+
+def test_source_tracks_version_from_sender_data():
+    source = rx._Source(("239.255.42.99", 1511), None, (2, 5, 0, 0))
+    packet = source.unpack(_read("test/data/frame-motive-1.9.0-000.bin"))
+    assert_is(type(packet), rx.SenderData)
+    assert_equal(source.version, (2, 9, 0, 0))
+    packet = source.unpack(_read("test/data/frame-motive-1.9.0-001.bin"))
+    assert_is(type(packet), rx.FrameOfData)
+
+
+def test_source_stats():
+    source = rx._Source(("239.255.42.99", 1511), None, (2, 7, 0, 0))
+    sizes = 0
+    for i in range(3):
+        data = _read("test/data/frame-motive-1.7.2-%03d.bin" % i)
+        sizes += len(data)
+        source.unpack(data)
+    source.unpack(b"\x08\x00\x04\x00oops")  # unsupported message string
+    stats = source.stats
+    print(stats)
+    assert_equal(stats.packets, 4)
+    assert_equal(stats.nbytes, sizes + 8)
+    assert_equal(stats.errors, 1)
+    assert_equal(stats.frames, 2)
+    assert_equal(stats.dropped_frames, 0)
+    assert_equal(stats.last_frameno, 411214)
+
+
+def test_source_does_not_count_broken_frames():
+    source = rx._Source(("239.255.42.99", 1511), None, (2, 9, 0, 0))
+    data = _read("test/data/frame-motive-1.9.0-001.bin")
+    assert_is(source.unpack(data[:40]), None)  # truncated
+    assert_equal(source.stats.errors, 1)
+    assert_equal(source.stats.frames, 0)
+    assert_is(source.stats.last_frameno, None)
+    source.unpack(data)
+    assert_equal(source.stats.frames, 1)
+    assert_equal(source.stats.last_frameno, 11823217)
+
+
+def test_source_counts_skipped_frames():
+    source = rx._Source(("239.255.42.99", 1511), None, (2, 9, 0, 0), rx.Dispatcher())
+    assert_is(source.unpack(_read("test/data/frame-motive-1.9.0-001.bin")), None)
+    assert_equal(source.stats.errors, 0)
+    assert_equal(source.stats.frames, 1)
+    assert_equal(source.stats.last_frameno, 11823217)
+
+
+def test_receive_reads_a_limited_batch():
+    thread = rx.MultiSourceThread(recv_batch=2)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.setblocking(0)
+    source = rx._Source(("239.255.42.99", 1511), sock, (2, 9, 0, 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        data = _read("test/data/frame-motive-1.9.0-001.bin")
+        for _ in range(5):
+            sender.sendto(data, sock.getsockname())
+        _wait_until(lambda: select.select([sock], [], [], 0)[0])
+        time.sleep(0.1)
+        # the rest is left for the next poll
+        assert_equal([len(thread._receive(source)) for _ in range(4)], [2, 2, 1, 0])
+    finally:
+        sock.close()
+        sender.close()
+
+
+class LoopbackSockets(object):
+    "Replace mkdatasock with UDP sockets bound to the loopback interface."
+
+    def __init__(self):
+        self.sockets = []
+
+    def __call__(self, ip_address=None, multicast_address=None, port=None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        self.sockets.append(sock)
+        return sock
+
+
+def _wait_for_packets(thread, n):
+    packets = []
+    deadline = time.time() + 5
+    while len(packets) < n and time.time() < deadline:
+        packets.extend(thread.get_packets())
+    return packets
+
+
+def _wait_until(condition):
+    deadline = time.time() + 5
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    assert condition(), "timed out"
+
+
+def _last_buffered_frameno(thread):
+    with thread._packet_lock:
+        if thread._packet_buf:
+            return getattr(thread._packet_buf[-1].packet, "frameno", None)
+
+
+def _run_multi_source_thread():
+    fake = LoopbackSockets()
+    real = rx.mkdatasock
+    rx.mkdatasock = fake
+    try:
+        thread = rx.MultiSourceThread(packet_limit=2)
+        a = thread.add_source("239.255.42.99", 1511)
+        b = thread.add_source("239.255.42.100", 1512)
+    finally:
+        rx.mkdatasock = real
+    assert_raises(ValueError, thread.add_source, "239.255.42.101", 1511)
+    assert_equal(sorted(thread.sources()), sorted([a, b]))
+
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    data = [_read("test/data/frame-motive-1.9.0-%03d.bin" % i) for i in range(3)]
+    try:
+        thread.start()
+        for d in data:
+            sender.sendto(d, fake.sockets[1].getsockname())
+        # all datagrams are received and the last frame is queued
+        _wait_until(lambda: thread.get_stats(b).packets == 3)
+        _wait_until(lambda: _last_buffered_frameno(thread) == 11823218)
+        packets = thread.get_packets()
+        assert_equal([p.source for p in packets], [b, b])  # packet_limit
+        assert_equal([type(p.packet) for p in packets], [rx.FrameOfData] * 2)
+        assert_equal(thread.get_version(b), (2, 9, 0, 0))
+        assert_equal(thread.get_version(a), (2, 5, 0, 0))
+
+        thread.remove_source(b)
+        assert_equal(thread.sources(), [a])
+        sender.sendto(data[0], fake.sockets[0].getsockname())
+        packets = _wait_for_packets(thread, 1)
+        assert_equal([p.source for p in packets], [a])
+        assert_equal(thread.get_version(a), (2, 9, 0, 0))
+        assert_equal(thread.get_stats(a).packets, 1)
+    finally:
+        thread.cancel()
+        thread.join(5)
+        sender.close()
+    assert_false(thread.is_alive())
+    assert_equal(thread.sources(), [])
+    for sock in fake.sockets:
+        assert_raises(socket.error, sock.recv, 1)  # closed
+
+
+def test_multi_source_thread_with_selectors():
+    if rx.selectors is None:
+        raise SkipTest("selectors module is not available")
+    _run_multi_source_thread()
+
+
+def test_multi_source_thread_with_select():
+    saved = rx.selectors
+    rx.selectors = None
+    try:
+        _run_multi_source_thread()
+    finally:
+        rx.selectors = saved
+
+
+def test_data_thread_tracks_version_with_dispatcher():
+    fake = LoopbackSockets()
+    real = rx.mkdatasock
+    rx.mkdatasock = fake
+    try:
+        d = rx.Dispatcher()
+        bodies = []
+        d.subscribe(lambda rb, frame: bodies.append(rb.id), rigid_body=2)
+        thread = rx.DataThread(version=(2, 5, 0, 0), dispatcher=d)
+    finally:
+        rx.mkdatasock = real
+    try:
+        # nobody subscribed to SenderData, but it sets the version
+        for i in range(2):
+            thread._process(_read("test/data/frame-motive-1.9.0-%03d.bin" % i))
+        assert_equal(thread._decoder.version, (2, 9, 0, 0))
+        assert_equal(bodies, [2])
+    finally:
+        fake.sockets[0].close()
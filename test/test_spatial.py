@@ -0,0 +1,77 @@
+from __future__ import print_function
+from unittest import SkipTest
+from nose.tools import assert_equal
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+import optirx as rx
+
+
+def _brute_force(points, queries):
+    d = np.sqrt(((queries[:, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+    return d
+
+
+def test_query_radius_and_nearest_match_brute_force():
+    if np is None:
+        raise SkipTest("NumPy is not installed")
+    rng = np.random.RandomState(0)
+    points = rng.uniform(-2, 2, (500, 3))
+    queries = np.vstack([points + rng.normal(0, 0.01, points.shape),
+                         [(10, 10, 10)]])
+    index = rx.MarkerIndex(points, cell_size=0.05)
+    for radius in (0.02, 0.05, 0.12):
+        d = _brute_force(points, queries)
+        found = index.query_radius(queries, radius)
+        for i in range(len(queries)):
+            assert_equal(sorted(found[i].tolist()),
+                         np.nonzero(d[i] <= radius)[0].tolist())
+        nearest, dists = index.nearest(queries, radius)
+        expected = np.where(d.min(axis=1) <= radius, d.argmin(axis=1), -1)
+        assert_equal(nearest.tolist(), expected.tolist())
+        assert np.isinf(dists[-1])
+
+
+def test_index_with_outlier():
+    if np is None:
+        raise SkipTest("NumPy is not installed")
+    rng = np.random.RandomState(2)
+    points = np.vstack([rng.uniform(-3, 3, (1000, 3)), [(100, 100, 0)]])
+    index = rx.MarkerIndex(points, cell_size=0.01)
+    # only occupied columns of cells are stored
+    assert len(index._colstart) <= len(points) + 1
+    queries = np.vstack([points[:10] + 0.001, [(100, 100, 0.005)]])
+    nearest, _ = index.nearest(queries)
+    assert_equal(nearest.tolist(), list(range(10)) + [1000])
+
+
+def test_index_from_frame():
+    if np is None:
+        raise SkipTest("NumPy is not installed")
+    with open("test/data/frame-motive-1.7.2-001.bin", "rb") as f:
+        frame = rx.unpack(f.read(), (2, 7, 0, 0))
+    index = rx.MarkerIndex.from_frame(frame, cell_size=0.05)
+    assert_equal(len(index), len(frame.other_markers))
+    nearest, _ = index.nearest(frame.other_markers, 0.001)
+    assert_equal(nearest.tolist(), list(range(len(frame.other_markers))))
+    index = rx.MarkerIndex.from_frame(frame, sets=True)
+    assert_equal(len(index), len(frame.other_markers) +
+                 sum(len(m) for m in frame.sets.values()))
+
+
+def test_match_markers():
+    if np is None:
+        raise SkipTest("NumPy is not installed")
+    rng = np.random.RandomState(1)
+    previous = rng.uniform(-2, 2, (300, 3))
+    shuffle = rng.permutation(300)
+    current = previous[shuffle] + rng.normal(0, 0.001, previous.shape)
+    current = np.vstack([current[:-1], [(10, 10, 10)]])  # one marker is lost
+    matches = rx.match_markers(previous, current, max_distance=0.01)
+    expected = np.argsort(shuffle)
+    expected[shuffle[-1]] = -1
+    assert_equal(matches.tolist(), expected.tolist())
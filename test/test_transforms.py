@@ -0,0 +1,89 @@
+from __future__ import print_function
+import math
+import struct
+from unittest import SkipTest
+from nose.tools import assert_equal, assert_raises
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+import optirx as rx
+
+
+def _cstring(s):
+    return s.encode("utf-8") + b"\0"
+
+
+def _modeldef_packet():
+    "NatNet 2.9 ModelDefs with a marker set, a rigid body and a skeleton."
+    payload = [struct.pack("i", 3)]
+    payload.append(struct.pack("i", rx.DATASET_MARKERSET) + _cstring("all") +
+                   struct.pack("i", 2) + _cstring("m1") + _cstring("m2"))
+    payload.append(struct.pack("i", rx.DATASET_RIGIDBODY) + _cstring("Body") +
+                   struct.pack("2i3f", 7, -1, 0, 0, 0))
+    payload.append(struct.pack("i", rx.DATASET_SKELETON) + _cstring("Arm") +
+                   struct.pack("2i", 5, 3))
+    for bone, parent, offset in [(1, 0, (0, 0, 0)), (2, 1, (1, 0, 0)), (3, 2, (0, 2, 0))]:
+        payload.append(_cstring("bone%d" % bone) + struct.pack("2i3f", bone, parent, *offset))
+    payload = b"".join(payload)
+    return struct.pack(rx.PACKET_HEADER_FORMAT, rx.NAT_MODELDEF, len(payload)) + payload
+
+
+def _axis_angle(axis, angle):
+    s = math.sin(angle / 2)
+    return tuple(c * s for c in axis) + (math.cos(angle / 2),)
+
+
+def test_unpack_modeldef():
+    defs = rx.unpack(_modeldef_packet(), (2, 9, 0, 0))
+    assert_equal([d.type for d in defs.datasets],
+                 [rx.DATASET_MARKERSET, rx.DATASET_RIGIDBODY, rx.DATASET_SKELETON])
+    assert_equal(defs.datasets[0].data, ["m1", "m2"])
+    skeleton = defs.datasets[2].data
+    assert_equal(skeleton["id"], 5)
+    assert_equal([(b["id"], b["parent"]) for b in skeleton["rigid_bodies"]],
+                 [(1, 0), (2, 1), (3, 2)])
+
+
+def test_forward_kinematics():
+    if np is None:
+        raise SkipTest("NumPy is not installed")
+    engine = rx.TransformEngine(rx.unpack(_modeldef_packet(), (2, 9, 0, 0)))
+    turn = _axis_angle((0, 0, 1), math.pi / 2)
+    still = (0.0, 0.0, 0.0, 1.0)
+    bones = [rx.RigidBody(1, (10.0, 0.0, 0.0), turn, [], None, None, None, None),
+             # the skeleton ID may be in the high word
+             rx.RigidBody((5 << 16) | 2, (0.0, 0.0, 0.0), turn, [], None, None, None, None),
+             rx.RigidBody(3, (0.0, 0.0, 0.0), still, [], None, None, None, None)]
+    frame = rx.FrameOfData(1, {}, [], [], [rx.Skeleton(5, bones)], [],
+                           0.0, (0, 0), None, None, None)
+    pos, ori = engine.forward_kinematics(frame)
+    # bone 2 is 1 along the x axis of bone 1, which is turned to y;
+    # bone 3 is 2 along the y axis of bone 2, which is turned to -y
+    expected = [(10, 0, 0), (10, 1, 0), (10, -1, 0)]
+    assert np.allclose(pos, expected), pos
+    assert np.allclose(ori[2], _axis_angle((0, 0, 1), math.pi)) or \
+        np.allclose(ori[2], -np.array(_axis_angle((0, 0, 1), math.pi)))
+    assert_equal(engine.bone_number(5, 3), 2)
+
+
+def test_world_to_local_and_back():
+    if np is None:
+        raise SkipTest("NumPy is not installed")
+    with open("test/data/frame-motive-1.9.0-001.bin", "rb") as f:
+        frame = rx.unpack(f.read(), (2, 9, 0, 0))
+    engine = rx.TransformEngine()
+    local, owner = engine.world_to_local(frame)
+    local = local.copy()
+    rb = frame.rigid_bodies[0]
+    assert_equal(len(local), len(rb.markers))
+    # rotation keeps distances to the body origin
+    assert np.allclose(np.linalg.norm(local, axis=1),
+                       np.linalg.norm(np.subtract(rb.markers, rb.position), axis=1))
+    world = engine.local_to_world(frame, local, owner)
+    assert np.allclose(world, rb.markers)
+    assert_raises(ValueError, engine.world_to_local, frame, rb.markers)
+    assert_raises(ValueError, engine.world_to_local, frame, owner=owner)